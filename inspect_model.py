@@ -1,6 +1,7 @@
-import onnxruntime as ort
+from onnx_session import create_session
 
-sess = ort.InferenceSession('models/speaker_embedding.onnx')
+# No optimized-graph cache: this reports on the model file itself
+sess = create_session('models/speaker_embedding.opt.onnx')
 meta = sess.get_modelmeta()
 
 print('Model metadata:')
@@ -0,0 +1,111 @@
+"""
+ONNX Runtime session setup shared by the Python model scripts.
+
+Nothing here builds a session at import time.
+"""
+
+import os
+import platform
+import onnxruntime as ort
+
+# Optional: custom ops (AudioDecoder) for models that decode WAV bytes in-graph
+try:
+    from onnxruntime_extensions import get_library_path as ortx_library_path
+except ImportError:
+    ortx_library_path = None
+
+# Execution providers in order of preference: TensorRT/CUDA on GPU machines,
+# OpenVINO (lowers QDQ models to INT8 kernels), then plain CPU
+PREFERRED_PROVIDERS = [
+    "TensorrtExecutionProvider",
+    "CUDAExecutionProvider",
+    "OpenVINOExecutionProvider",
+    "CPUExecutionProvider",
+]
+
+# Caching TensorRT engines avoids the long first-run build. FP16 engines are
+# opt-in (create_session's trt_fp16): waveform-input models keep their in-graph
+# frontend in FP32, and an FP16 engine would be free to run it in half precision.
+TRT_CACHE_PATH = "models/trt_cache"
+PROVIDER_OPTIONS = {
+    "TensorrtExecutionProvider": {
+        "trt_engine_cache_enable": "1",
+    },
+}
+
+def select_providers():
+    """Preferred execution providers that this onnxruntime build actually has."""
+    available = ort.get_available_providers()
+    return [ep for ep in PREFERRED_PROVIDERS if ep in available]
+
+def optimized_cache_path(model_path):
+    """
+    Where create_session caches the ORT_ENABLE_ALL graph for model_path.
+    
+    ENABLE_ALL graphs may contain layout ops specific to the ORT build and CPU,
+    so the ORT version and machine architecture are part of the file name.
+    """
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.ort{ort.__version__}-{platform.machine().lower()}.cache{ext}"
+
+def cache_supported():
+    """Whether create_session can cache the optimized graph with the current providers."""
+    return select_providers() == ["CPUExecutionProvider"]
+
+def create_session_options():
+    """
+    CPU session options: full graph fusion, one intra-op thread per physical core.
+    """
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.intra_op_num_threads = max(1, (os.cpu_count() or 2) // 2)  # physical cores (assumes SMT)
+    so.inter_op_num_threads = 1
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.enable_mem_pattern = True
+    so.enable_cpu_mem_arena = True
+    if ortx_library_path is not None:
+        so.register_custom_ops_library(ortx_library_path())
+    return so
+
+def trt_cache_path(trt_fp16=False):
+    """TensorRT engine cache directory; FP16 and FP32 engines are kept apart."""
+    return os.path.join(TRT_CACHE_PATH, "fp16" if trt_fp16 else "fp32")
+
+def create_session(model_path, use_cache=False, trt_fp16=False):
+    """
+    Create an inference session, optionally caching the optimized graph on disk.
+    
+    With use_cache, the first run optimizes model_path and saves the result to
+    optimized_cache_path(model_path); later runs load the saved graph directly
+    and skip the optimizer passes. The cache is rebuilt whenever the source
+    model is newer than it. Caching is skipped when a compiling provider
+    (TensorRT, OpenVINO) is used, since ORT cannot serialize graphs containing
+    compiled nodes.
+    
+    trt_fp16 lets TensorRT build FP16 engines. Only pass it for feature-input
+    models; waveform-input models need their frontend in FP32.
+    """
+    so = create_session_options()
+    providers = select_providers()
+    use_cache = use_cache and cache_supported()
+    optimized_path = optimized_cache_path(model_path)
+    
+    if (use_cache and os.path.exists(optimized_path)
+            and os.path.getmtime(optimized_path) >= os.path.getmtime(model_path)):
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        model_path = optimized_path
+    elif use_cache:
+        so.optimized_model_filepath = optimized_path
+    
+    provider_options = {ep: dict(PROVIDER_OPTIONS.get(ep, {})) for ep in providers}
+    if "TensorrtExecutionProvider" in providers:
+        trt_options = provider_options["TensorrtExecutionProvider"]
+        trt_options["trt_fp16_enable"] = "1" if trt_fp16 else "0"
+        trt_options["trt_engine_cache_path"] = trt_cache_path(trt_fp16)
+        os.makedirs(trt_options["trt_engine_cache_path"], exist_ok=True)
+    
+    return ort.InferenceSession(
+        model_path,
+        sess_options=so,
+        providers=[(ep, provider_options[ep]) for ep in providers],
+    )
@@ -2,17 +2,109 @@
 """
 Export SpeechBrain ECAPA-TDNN speaker embedding model to ONNX format.
 
+SpeechBrain's feature frontend (Fbank + sentence mean normalization) is
+exported as part of the graph, so the model takes raw 16kHz waveform
+[batch, samples] and returns embeddings [batch, dim].
+
 Requirements:
     pip install torch torchaudio speechbrain onnx
+    pip install onnxruntime soundfile
+    pip install onnxconverter-common  # only for --fp16
+    pip install onnxruntime-extensions  # only for --audio-decoder
+
+The Python test scripts (test_wespeaker_python.py, inspect_model.py) load the
+ORT-optimized *.opt.onnx written next to the plain export by default.
 """
 
+import numpy as np
 import torch
 import torch.nn as nn
+import argparse
 import sys
 import os
 
-def export_ecapa_to_onnx(output_path="models/speaker_embedding.onnx"):
-    """Export ECAPA-TDNN model to ONNX format."""
+# Opset 17 adds the STFT op, so the in-graph frontend exports as one node
+# instead of a decomposed DFT
+OPSET_VERSION = 17
+
+# WAV files used to calibrate activation ranges for static quantization.
+# One file per recording: Sean_Carroll_podcast_16k.wav is the same audio
+# as Sean_Carroll_podcast.wav and would weight that podcast twice.
+CALIBRATION_FILES = [
+    "test_data/Sean_Carroll_podcast.wav",
+    "test_data/Tom_Hanks_podcast.wav",
+]
+
+class SpeechBrainFrontend(nn.Module):
+    """
+    The classifier's own features [batch, frames, n_mels] from waveform [batch, samples].
+    
+    Reproduces mods['compute_features'] (Fbank) followed by the sentence-level
+    normalization of mods['mean_var_norm'], i.e. the features the encoder was
+    trained on. SpeechBrain's STFT returns a complex tensor, which the ONNX
+    exporter rejects, so the STFT is computed real-valued here with the same
+    parameters; the filterbank and dB conversion are SpeechBrain's own.
+    InputNormalization loops over the batch in Python, which tracing would
+    unroll into a fixed batch size, so its full-length 'sentence' case is
+    written out with tensor ops instead.
+    """
+    
+    def __init__(self, compute_features, mean_var_norm):
+        super().__init__()
+        if getattr(compute_features, 'deltas', False) or getattr(compute_features, 'context', False):
+            raise ValueError("Unsupported compute_features: deltas/context are not exported")
+        if getattr(mean_var_norm, 'norm_type', 'sentence') != 'sentence':
+            raise ValueError(f"Unsupported mean_var_norm norm_type: {mean_var_norm.norm_type}")
+        
+        stft = compute_features.compute_STFT
+        self.n_fft = stft.n_fft
+        self.hop_length = stft.hop_length
+        self.win_length = stft.win_length
+        self.center = stft.center
+        self.pad_mode = stft.pad_mode
+        self.normalized = stft.normalized_stft
+        self.onesided = stft.onesided
+        self.register_buffer('window', stft.window.detach().clone())
+        
+        self.compute_fbanks = compute_features.compute_fbanks
+        self.std_norm = bool(getattr(mean_var_norm, 'std_norm', False))
+        self.eps = float(getattr(mean_var_norm, 'eps', 1e-10))
+    
+    def forward(self, audio):
+        spec = torch.stft(
+            audio,
+            self.n_fft,
+            self.hop_length,
+            self.win_length,
+            window=self.window,
+            center=self.center,
+            pad_mode=self.pad_mode,
+            normalized=self.normalized,
+            onesided=self.onesided,
+            return_complex=False,
+        )  # [B, freqs, frames, 2]
+        power = spec.pow(2).sum(-1).transpose(1, 2)  # [B, frames, freqs], as spectral_magnitude()
+        
+        feats = self.compute_fbanks(power)
+        feats = feats - feats.mean(dim=1, keepdim=True)
+        if self.std_norm:
+            feats = feats / feats.std(dim=1, keepdim=True).clamp_min(self.eps)
+        return feats
+
+class WaveformEncoder(nn.Module):
+    """Feature frontend followed by the ECAPA encoder, exported as one graph."""
+    
+    def __init__(self, frontend, encoder):
+        super().__init__()
+        self.frontend = frontend
+        self.encoder = encoder
+    
+    def forward(self, audio):
+        embedding = self.encoder(self.frontend(audio))
+        return embedding.reshape(embedding.shape[0], -1)  # [B, 1, dim] -> [B, dim]
+
+def export_ecapa_to_onnx(output_path="models/speaker_embedding.onnx", verify=False):
+    """Export ECAPA-TDNN model to ONNX format (full checker pass only with verify=True)."""
     
     print("Loading SpeechBrain ECAPA-TDNN model...")
     try:
@@ -28,10 +120,14 @@ def export_ecapa_to_onnx(output_path="models/speaker_embedding.onnx"):
     )
     
     # Get the encoder (embedding extractor) module
-    encoder = classifier.mods['embedding_model']
-    encoder.eval()
+    ecapa = classifier.mods['embedding_model']
     
-    print(f"Model loaded. Embedding dim: {encoder.out_features if hasattr(encoder, 'out_features') else 'unknown'}")
+    print(f"Model loaded. Embedding dim: {ecapa.out_features if hasattr(ecapa, 'out_features') else 'unknown'}")
+    
+    # Prefix the classifier's own feature extraction so the graph consumes raw waveform
+    frontend = SpeechBrainFrontend(classifier.mods['compute_features'], classifier.mods['mean_var_norm'])
+    encoder = WaveformEncoder(frontend, ecapa)
+    encoder.eval()
     
     # Create dummy input: 1 second of audio at 16kHz
     sample_rate = 16000
@@ -43,13 +139,22 @@ def export_ecapa_to_onnx(output_path="models/speaker_embedding.onnx"):
     # Test forward pass
     with torch.no_grad():
         try:
-            # SpeechBrain ECAPA expects (batch, time)
+            # Waveform (batch, time) -> Fbank (batch, frames, 80) -> ECAPA
             embedding = encoder(dummy_input)
             print(f"Output embedding shape: {embedding.shape}")
+            
+            # The wrapper must match SpeechBrain's own inference path
+            reference = classifier.encode_batch(dummy_input).reshape(embedding.shape)
         except Exception as e:
             print(f"ERROR during forward pass: {e}")
             return False
     
+    max_diff = (embedding - reference).abs().max().item()
+    print(f"Parity vs classifier.encode_batch: max |diff| = {max_diff:.2e}")
+    if max_diff > 1e-4:
+        print("ERROR: wrapped frontend does not reproduce classifier.encode_batch")
+        return False
+    
     # Ensure output directory exists
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
@@ -66,17 +171,42 @@ def export_ecapa_to_onnx(output_path="models/speaker_embedding.onnx"):
                 'audio': {0: 'batch', 1: 'time'},
                 'embedding': {0: 'batch'}
             },
-            opset_version=14,
-            do_constant_folding=True,
+            opset_version=OPSET_VERSION,
+            do_constant_folding=False,  # ORT's optimizer folds and fuses more (see optimize_with_ort)
             export_params=True,
         )
         print(f"✅ Model exported successfully to {output_path}")
         
-        # Verify the exported model
+        # Check the exported graph itself, at a batch size and length other
+        # than the traced ones so the dynamic axes are exercised too
+        import onnxruntime as ort
+        check_input = torch.randn(2, int(sample_rate * 2.5))
+        with torch.no_grad():
+            reference = classifier.encode_batch(check_input).reshape(2, -1).numpy()
+        check_sess = ort.InferenceSession(output_path, providers=['CPUExecutionProvider'])
+        onnx_embedding = check_sess.run(None, {'audio': check_input.numpy()})[0]
+        
+        max_diff = float(np.abs(onnx_embedding - reference).max())
+        print(f"ONNX parity vs classifier.encode_batch: max |diff| = {max_diff:.2e}")
+        if max_diff > 1e-4:
+            print("ERROR: exported model does not reproduce classifier.encode_batch")
+            return False
+        
+        # Read the graph for reporting without pulling in external tensor data
         import onnx
-        onnx_model = onnx.load(output_path)
-        onnx.checker.check_model(onnx_model)
-        print("✅ ONNX model verified")
+        onnx_model = onnx.load(output_path, load_external_data=False)
+        
+        # Full graph walk is slow on a model this size - only on request
+        if verify:
+            onnx.checker.check_model(output_path)  # path-based, avoids re-serializing in memory
+            print("✅ ONNX model verified")
+        
+        # The frontend's STFT exports as a single opset-17 STFT node instead of
+        # a DFT-as-Conv decomposition
+        opset = next(o.version for o in onnx_model.opset_import if o.domain in ("", "ai.onnx"))
+        stft_nodes = sum(1 for node in onnx_model.graph.node if node.op_type == 'STFT')
+        print(f"  Opset: {opset}")
+        print(f"  STFT nodes: {stft_nodes}")
         
         # Print model info
         print("\nModel Information:")
@@ -91,7 +221,329 @@ def export_ecapa_to_onnx(output_path="models/speaker_embedding.onnx"):
         traceback.print_exc()
         return False
 
+def optimize_with_ort(model_path, output_path=None):
+    """
+    Run ORT's graph optimizer offline and save the result as *.opt.onnx.
+    
+    EXTENDED level applies constant folding plus Conv+BN/LayerNorm/Gelu fusions
+    but no hardware-specific layout transforms, so the file stays portable.
+    Sessions loading it still run ORT_ENABLE_ALL on top; the test scripts
+    cache that result under a separate, ORT-version-specific name.
+    """
+    output_path = output_path or model_path.replace('.onnx', '.opt.onnx')
+    
+    print(f"\nOptimizing {model_path} -> {output_path} (ORT_ENABLE_EXTENDED)...")
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("ERROR: onnxruntime not installed. Run: pip install onnxruntime")
+        return False
+    
+    try:
+        so = ort.SessionOptions()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        so.optimized_model_filepath = output_path
+        ort.InferenceSession(model_path, so, providers=['CPUExecutionProvider'])  # triggers save
+        print(f"✅ Optimized model written to {output_path}")
+        return True
+        
+    except Exception as e:
+        print(f"ERROR during optimization: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+def preprocess_for_conversion(model_path, output_path=None):
+    """
+    Constant-fold and shape-infer the export into *.pre.onnx for --fp16/--int8/--qdq.
+    
+    The export skips constant folding, so the converters would otherwise see
+    an unfolded graph. quant_pre_process only applies basic ORT optimizations,
+    so no com.microsoft fused ops reach the converters.
+    """
+    output_path = output_path or model_path.replace('.onnx', '.pre.onnx')
+    
+    print(f"\nPreprocessing {model_path} -> {output_path}...")
+    try:
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+    except ImportError:
+        print("ERROR: onnxruntime not installed. Run: pip install onnxruntime")
+        return False
+    
+    try:
+        quant_pre_process(model_path, output_path)
+        print(f"✅ Preprocessed model written to {output_path}")
+        return True
+        
+    except Exception as e:
+        print(f"ERROR during preprocessing: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+# Kept in FP32 in the --fp16/--int8/--qdq models: Fbank frontend (power
+# spectrum exceeds the FP16/INT8 range), attentive statistics pooling and the
+# final projection
+FP32_NODE_PREFIXES = ('/frontend/', '/encoder/asp', '/encoder/fc')
+FP32_OP_TYPES = ['ReduceMean', 'ReduceSum', 'Softmax']
+
+# Ops that only appear in a graph once something was actually quantized
+QUANTIZED_OP_TYPES = {'MatMulInteger', 'ConvInteger', 'DynamicQuantizeMatMul', 'QuantizeLinear'}
+
+def fp32_node_names(model_path):
+    """Names of the nodes matching FP32_NODE_PREFIXES in the model at model_path."""
+    import onnx
+    model = onnx.load(model_path, load_external_data=False)
+    return [n.name for n in model.graph.node if n.name.startswith(FP32_NODE_PREFIXES)]
+
+def count_quantized_nodes(model_path):
+    """Number of quantization nodes in the model at model_path."""
+    import onnx
+    model = onnx.load(model_path, load_external_data=False)
+    return sum(1 for n in model.graph.node if n.op_type in QUANTIZED_OP_TYPES)
+
+def add_audio_decoder(model_path, output_path=None, sample_rate=16000):
+    """
+    Write a copy of the model that takes encoded audio bytes.
+    
+    Prepends the onnxruntime-extensions AudioDecoder op (decode, downmix,
+    resample to 16kHz), so the session input is the raw WAV file contents
+    as uint8 [1, n_bytes]. Running it requires registering the extensions
+    custom ops library with the session. Pass the deployed *.opt.onnx so
+    the bytes-input model carries the optimized graph.
+    """
+    output_path = output_path or model_path.replace('.onnx', '.bytes.onnx')
+    
+    print(f"\nAdding AudioDecoder: {model_path} -> {output_path}...")
+    try:
+        import onnx
+        from onnx import TensorProto, compose, helper
+        import onnxruntime_extensions  # noqa: F401 - only checks the runtime is available
+    except ImportError:
+        print("ERROR: onnxruntime-extensions not installed. Run: pip install onnxruntime-extensions")
+        return False
+    
+    try:
+        model = onnx.load(model_path)
+        opset = next(o.version for o in model.opset_import if o.domain in ("", "ai.onnx"))
+        
+        decoder_graph = helper.make_graph(
+            [helper.make_node(
+                'AudioDecoder', ['audio_stream'], ['pcm'],
+                domain='ai.onnx.contrib',
+                downsampling_rate=sample_rate,
+                stereo_to_mono=1,
+            )],
+            'audio_decoder',
+            [helper.make_tensor_value_info('audio_stream', TensorProto.UINT8, [1, 'n_bytes'])],
+            [helper.make_tensor_value_info('pcm', TensorProto.FLOAT, [1, 'time'])],
+        )
+        decoder = helper.make_model(decoder_graph, opset_imports=[
+            helper.make_opsetid('', opset),
+            helper.make_opsetid('ai.onnx.contrib', 1),
+        ])
+        decoder.ir_version = model.ir_version
+        
+        merged = compose.merge_models(decoder, model, io_map=[('pcm', 'audio')])
+        onnx.save(merged, output_path)
+        print(f"✅ Bytes-input model written to {output_path}")
+        return True
+        
+    except Exception as e:
+        print(f"ERROR while adding AudioDecoder: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+def convert_fp16(model_path, output_path=None):
+    """
+    Write a mixed-precision copy of the exported model with FP16 encoder weights.
+    
+    Inputs/outputs stay FP32 so callers feed the same tensors; the frontend,
+    pooling and final projection stay FP32 for clustering stability.
+    """
+    output_path = output_path or model_path.replace('.onnx', '.fp16.onnx')
+    
+    print(f"\nConverting {model_path} -> {output_path} (FP16 encoder)...")
+    try:
+        import onnx
+        from onnxconverter_common import float16
+    except ImportError:
+        print("ERROR: onnxconverter-common not installed. Run: pip install onnxconverter-common")
+        return False
+    
+    try:
+        model = onnx.load(model_path)
+        fp32_nodes = fp32_node_names(model_path)
+        model_fp16 = float16.convert_float_to_float16(
+            model,
+            keep_io_types=True,
+            op_block_list=FP32_OP_TYPES,
+            node_block_list=fp32_nodes,
+        )
+        onnx.save(model_fp16, output_path)
+        print(f"✅ FP16 model written to {output_path} ({len(fp32_nodes)} nodes kept in FP32)")
+        return True
+        
+    except Exception as e:
+        print(f"ERROR during FP16 conversion: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+def quantize_int8(model_path, output_path=None):
+    """
+    Write a dynamic INT8 copy of the exported model (MatMul weights only).
+    
+    Signed INT8 weights map onto AVX512-VNNI dot-product kernels. Conv is left
+    in FP32: quantized Conv1d without VNNI Conv kernels runs slower than FP32.
+    Nodes in FP32_NODE_PREFIXES are excluded, in particular the frontend's
+    mel projection, whose power-spectrum input would not survive 8 bits.
+    
+    Limitation: SpeechBrain ECAPA-TDNN has no MatMul outside the frontend -
+    its projections, SE blocks, pooling and fc are all Conv1d - so for that
+    model nothing is quantized and no .int8.onnx is written. That is reported
+    as a warning, not a failure, so later variants are still produced. Use
+    --qdq instead, which quantizes Conv.
+    """
+    output_path = output_path or model_path.replace('.onnx', '.int8.onnx')
+    
+    print(f"\nQuantizing {model_path} -> {output_path} (INT8, MatMul only)...")
+    try:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError:
+        print("ERROR: onnxruntime not installed. Run: pip install onnxruntime")
+        return False
+    
+    try:
+        quantize_dynamic(
+            model_path,
+            output_path,
+            op_types_to_quantize=['MatMul'],
+            nodes_to_exclude=fp32_node_names(model_path),
+            weight_type=QuantType.QInt8,  # QUInt8 weights are slower on VNNI
+            per_channel=True,
+            reduce_range=False,
+        )
+        
+        # Don't leave an FP32 copy behind under an .int8.onnx name
+        if count_quantized_nodes(output_path) == 0:
+            os.remove(output_path)
+            print("WARNING: no MatMul outside the FP32 frontend/pooling to quantize "
+                  "(ECAPA-TDNN projections are Conv1d); skipped, use --qdq instead")
+            return True
+        
+        print(f"✅ INT8 model written to {output_path}")
+        return True
+        
+    except Exception as e:
+        print(f"ERROR during quantization: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+def load_calibration_audio(files=CALIBRATION_FILES, clip_seconds=1.0, clips_per_file=16, sample_rate=16000):
+    """Cut evenly spaced fixed-length clips [1, T] from each of the given WAV files."""
+    import soundfile as sf
+    import torchaudio
+    
+    clip_len = int(clip_seconds * sample_rate)
+    clips = []
+    for path in files:
+        audio, sr = sf.read(path, dtype='float32', always_2d=True)
+        audio = audio.mean(axis=1)
+        if sr != sample_rate:
+            audio = torchaudio.functional.resample(torch.from_numpy(audio), sr, sample_rate).numpy()
+        
+        n_clips = len(audio) // clip_len
+        for idx in np.linspace(0, n_clips - 1, num=min(clips_per_file, n_clips), dtype=int):
+            clips.append(audio[idx * clip_len:(idx + 1) * clip_len][np.newaxis, :])
+    
+    return clips
+
+def quantize_qdq(model_path, output_path=None, calibration_files=CALIBRATION_FILES):
+    """
+    Write a static INT8 copy of the exported model in QDQ format.
+    
+    Activation ranges are calibrated on clips from calibration_files. QDQ
+    models run natively in ORT on VNNI CPUs and are lowered to INT8 kernels by
+    the OpenVINO execution provider elsewhere. Nodes in FP32_NODE_PREFIXES
+    (frontend, pooling, fc) stay in FP32, as in convert_fp16.
+    """
+    output_path = output_path or model_path.replace('.onnx', '.qdq.onnx')
+    
+    print(f"\nQuantizing {model_path} -> {output_path} (static INT8, QDQ)...")
+    try:
+        from onnxruntime.quantization import (
+            quantize_static, CalibrationDataReader, QuantFormat, QuantType
+        )
+    except ImportError:
+        print("ERROR: onnxruntime not installed. Run: pip install onnxruntime")
+        return False
+    
+    class AudioCalibReader(CalibrationDataReader):
+        def __init__(self, clips):
+            self.it = iter([{'audio': clip} for clip in clips])
+        
+        def get_next(self):
+            return next(self.it, None)
+    
+    try:
+        clips = load_calibration_audio(calibration_files)
+        print(f"Calibrating on {len(clips)} clips from {len(calibration_files)} files")
+        
+        quantize_static(
+            model_path,
+            output_path,
+            AudioCalibReader(clips),
+            quant_format=QuantFormat.QDQ,
+            op_types_to_quantize=['MatMul', 'Conv'],
+            nodes_to_exclude=fp32_node_names(model_path),
+            per_channel=True,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8,
+        )
+        print(f"✅ QDQ model written to {output_path} ({count_quantized_nodes(output_path)} QuantizeLinear nodes)")
+        return True
+        
+    except Exception as e:
+        print(f"ERROR during quantization: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
 if __name__ == "__main__":
-    output_path = sys.argv[1] if len(sys.argv) > 1 else "models/speaker_embedding.onnx"
-    success = export_ecapa_to_onnx(output_path)
+    parser = argparse.ArgumentParser(description="Export ECAPA-TDNN speaker embedding model to ONNX")
+    parser.add_argument("output_path", nargs="?", default="models/speaker_embedding.onnx")
+    parser.add_argument("--verify", action="store_true",
+                        help="Run the full ONNX checker on the exported model")
+    parser.add_argument("--audio-decoder", action="store_true",
+                        help="Also write a model that takes WAV file bytes (*.bytes.onnx)")
+    parser.add_argument("--fp16", action="store_true",
+                        help="Also write a mixed-precision FP16 model (*.fp16.onnx)")
+    parser.add_argument("--int8", action="store_true",
+                        help="Also write a dynamic INT8 model (*.int8.onnx); skipped with a "
+                             "warning when the model has no MatMul to quantize")
+    parser.add_argument("--qdq", action="store_true",
+                        help="Also write a calibrated static INT8 QDQ model (*.qdq.onnx)")
+    args = parser.parse_args()
+    
+    base = args.output_path
+    success = export_ecapa_to_onnx(base, verify=args.verify)
+    if success:
+        success = optimize_with_ort(base)
+    if success and args.audio_decoder:
+        # Built on the deployed optimized graph, not the plain export
+        success = add_audio_decoder(base.replace('.onnx', '.opt.onnx'), base.replace('.onnx', '.bytes.onnx'))
+    
+    # Reduced-precision variants start from the constant-folded graph
+    preprocessed = base.replace('.onnx', '.pre.onnx')
+    if success and (args.fp16 or args.int8 or args.qdq):
+        success = preprocess_for_conversion(base, preprocessed)
+    if success and args.fp16:
+        success = convert_fp16(preprocessed, base.replace('.onnx', '.fp16.onnx'))
+    if success and args.int8:
+        success = quantize_int8(preprocessed, base.replace('.onnx', '.int8.onnx'))
+    if success and args.qdq:
+        success = quantize_qdq(preprocessed, base.replace('.onnx', '.qdq.onnx'))
     sys.exit(0 if success else 1)
@@ -5,20 +5,44 @@ ECAPA-TDNN has similar performance to Titanet Large (0.69% EER vs 0.66%),
 and SpeechBrain community might have ONNX versions available.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 from huggingface_hub import list_models
 
-def search_ecapa_onnx():
+# Independent Hub queries: name -> (search term, ONNX-only, limit)
+QUERIES = {
+    "ecapa": ("ecapa", False, 30),
+    "ecapa_onnx": ("ecapa", True, 30),
+    "speechbrain_onnx": ("speechbrain", True, 30),
+    "wespeaker": ("wespeaker", False, 20),
+    "wespeaker_onnx": ("wespeaker", True, 20),
+}
+
+def query_models(term, onnx_only, limit):
+    # library="onnx" filters on the Hub's library tag server-side, which also
+    # catches ONNX repos that don't have "onnx" in their name
+    if onnx_only:
+        return list(list_models(search=term, library="onnx", limit=limit))
+    return list(list_models(search=term, limit=limit))
+
+def run_queries():
+    """Run all Hub searches concurrently so their round-trips overlap."""
+    with ThreadPoolExecutor(max_workers=len(QUERIES)) as ex:
+        futures = {name: ex.submit(query_models, *args) for name, args in QUERIES.items()}
+        return {name: f.result() for name, f in futures.items()}
+
+def search_ecapa_onnx(results):
     print("=" * 60)
     print("Searching for ECAPA-TDNN ONNX models...")
     print("=" * 60)
     
     # Search for ECAPA models
     print("\n1. Searching for 'ecapa' models...")
-    ecapa_models = list(list_models(search="ecapa", limit=30))
+    ecapa_models = results["ecapa"]
     print(f"   Found {len(ecapa_models)} ECAPA-related models\n")
     
     # Filter for ONNX
-    onnx_models = [m for m in ecapa_models if 'onnx' in m.modelId.lower()]
+    onnx_models = results["ecapa_onnx"]
     
     if onnx_models:
         print(f"[OK] Found {len(onnx_models)} ECAPA ONNX models:")
@@ -27,8 +51,8 @@ def search_ecapa_onnx():
         return onnx_models
     
     # Search for SpeechBrain + ONNX
-    print("\n2. Searching for 'speechbrain onnx' models...")
-    sb_onnx = list(list_models(search="speechbrain onnx", limit=30))
+    print("\n2. Searching for 'speechbrain' ONNX models...")
+    sb_onnx = results["speechbrain_onnx"]
     print(f"   Found {len(sb_onnx)} SpeechBrain ONNX models\n")
     
     speaker_models = [m for m in sb_onnx if 'speaker' in m.modelId.lower() or 'ecapa' in m.modelId.lower()]
@@ -46,20 +70,20 @@ def search_ecapa_onnx():
     
     return []
 
-def search_wespeaker_alternatives():
+def search_wespeaker_alternatives(results):
     """Search for other WeSpeaker models that might work better."""
     print("\n" + "=" * 60)
     print("Searching for alternative WeSpeaker models...")
     print("=" * 60)
     
-    models = list(list_models(search="wespeaker", limit=20))
+    models = results["wespeaker"]
     print(f"\nFound {len(models)} WeSpeaker models:")
     
     for model in models:
         print(f"  - {model.modelId}")
     
     # Check for ONNX versions
-    onnx_models = [m for m in models if 'onnx' in m.modelId.lower()]
+    onnx_models = results["wespeaker_onnx"]
     if onnx_models:
         print(f"\n[OK] Found {len(onnx_models)} WeSpeaker ONNX models:")
         for model in onnx_models:
@@ -69,11 +93,13 @@ def search_wespeaker_alternatives():
     return []
 
 def main():
+    results = run_queries()
+    
     # Search ECAPA-TDNN
-    ecapa_results = search_ecapa_onnx()
+    ecapa_results = search_ecapa_onnx(results)
     
     # Search alternative WeSpeaker
-    wespeaker_results = search_wespeaker_alternatives()
+    wespeaker_results = search_wespeaker_alternatives(results)
     
     # Decision
     print("\n" + "=" * 60)
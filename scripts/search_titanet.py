@@ -11,6 +11,7 @@ If ONNX version not available, provides instructions for conversion from PyTorch
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 def check_huggingface():
@@ -21,9 +22,14 @@ def check_huggingface():
         # Try importing huggingface_hub
         from huggingface_hub import hf_hub_download, list_models
         
-        # Search for Titanet models
+        # Search for Titanet models; the ONNX-only query (library tag filtered
+        # server-side) runs concurrently so both round-trips overlap
         print("Searching for 'titanet' models...")
-        models = list(list_models(search="titanet", limit=20))
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            all_future = ex.submit(lambda: list(list_models(search="titanet", limit=20)))
+            onnx_future = ex.submit(lambda: list(list_models(search="titanet", library="onnx", limit=20)))
+            models = all_future.result()
+            onnx_models = onnx_future.result()
         
         if not models:
             print("[X] No Titanet models found on Hugging Face")
@@ -34,7 +40,6 @@ def check_huggingface():
             print(f"  {i}. {model.modelId}")
             
         # Look for ONNX versions
-        onnx_models = [m for m in models if 'onnx' in m.modelId.lower()]
         if onnx_models:
             print(f"\n[OK] Found {len(onnx_models)} ONNX models:")
             for model in onnx_models:
@@ -3,141 +3,320 @@ Test ONNX speaker embedding model with proper Fbank feature extraction.
 This proves the concept before implementing in C++.
 """
 
+import functools
+import logging
+import os
+import sys
+import weakref
+from collections import OrderedDict
 import numpy as np
 import onnxruntime as ort
 import librosa
 import soundfile as sf
+import torch
+import torchaudio
 
-def extract_fbank_features(audio_path, n_mels=80, n_fft=400, hop_length=160):
+from onnx_session import cache_supported, create_session, optimized_cache_path
+
+log = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000  # WeSpeaker expects 16kHz
+N_MELS = 80          # Number of mel bins (80 for WeSpeaker)
+N_FFT = 400          # FFT size (400 samples at 16kHz = 25ms)
+HOP_LENGTH = 160     # Hop size (160 samples at 16kHz = 10ms)
+
+# Defaults to the ORT-optimized export; any other variant works too
+# (*.bytes.onnx, *.fp16.onnx, ...)
+MODEL_PATH = os.environ.get("SPEAKER_EMBEDDING_MODEL", "models/speaker_embedding.opt.onnx")
+
+# Session construction parses and optimizes the graph - build it once and share it
+sess = create_session(MODEL_PATH, use_cache=True)
+_INPUT_NAME = sess.get_inputs()[0].name
+_OUTPUT_NAME = sess.get_outputs()[0].name
+
+# Pre-bound input buffers reused across embed_batch() calls: per session, the
+# most recently used (input_name, shape) bindings. Entries go away with the session.
+_BINDINGS = weakref.WeakKeyDictionary()
+_MAX_BINDINGS = 4
+
+# Models exported with the feature frontend in-graph take waveform [B, samples]
+# instead of features [B, T, 80]
+_WAVEFORM_INPUT = len(sess.get_inputs()[0].shape) == 2
+
+# Models exported with --audio-decoder take encoded WAV bytes [1, n_bytes] (uint8)
+# and run decoding, resampling and log-mel inside the session
+_BYTES_INPUT = sess.get_inputs()[0].type == "tensor(uint8)"
+
+# Built once at import so the STFT window and mel filterbank are reused on every call.
+# The filterbank is librosa's own (Slaney), so features match librosa.feature.melspectrogram.
+_WINDOW = torch.hann_window(N_FFT)  # periodic Hann, as librosa's "hann"
+# The filterbank is stored as [freqs, 80] so the projection yields [frames, 80] directly.
+_MEL_FB = torch.from_numpy(np.ascontiguousarray(
+    librosa.filters.mel(sr=SAMPLE_RATE, n_fft=N_FFT, n_mels=N_MELS, fmin=0, fmax=SAMPLE_RATE / 2).T,
+    dtype=np.float32,
+))  # [freqs, 80]
+
+def log_mel_features(audio, top_db=80.0):
     """
-    Extract Fbank (mel filterbank) features matching WeSpeaker's expected input.
+    Compute log-mel (Fbank) features for a 16kHz mono waveform.
+    
+    Equivalent to librosa.power_to_db(melspectrogram(...), ref=np.max).
     
     Parameters:
-    - audio_path: Path to audio file
-    - n_mels: Number of mel bins (80 for WeSpeaker)
-    - n_fft: FFT size (400 samples at 16kHz = 25ms)
-    - hop_length: Hop size (160 samples at 16kHz = 10ms)
+    - audio: np.array of float32 samples
+    - top_db: Dynamic range kept below the per-utterance maximum
     
     Returns:
-    - features: np.array of shape [1, time_steps, 80]
+    - features: np.array of shape [time_steps, 80]
     """
-    # Load audio at 16kHz (WeSpeaker expects 16kHz)
-    audio, sr = librosa.load(audio_path, sr=16000, mono=True)
+    with torch.no_grad():
+        spec = torch.stft(
+            torch.from_numpy(np.ascontiguousarray(audio, dtype=np.float32)),
+            N_FFT,
+            HOP_LENGTH,
+            window=_WINDOW,
+            center=True,
+            pad_mode="constant",
+            return_complex=True,
+        )
+        power = spec.abs().pow(2)  # Power spectrum [freqs, frames]
+        mel_spec = power.T @ _MEL_FB  # [frames, 80], contiguous
+        
+        # Convert to log scale (dB) relative to the utterance maximum
+        log_mel = 10.0 * torch.log10(mel_spec.clamp_min(1e-10))
+        log_mel = (log_mel - log_mel.max()).clamp_min(-top_db)
     
-    print(f"Audio loaded: {len(audio)} samples, {sr} Hz, {len(audio)/sr:.2f} seconds")
+    # Already [time, features]; .numpy() shares memory with the tensor
+    return log_mel.numpy()
+
+@functools.lru_cache(maxsize=None)
+def _resampler(orig_sr):
+    """Resampler from orig_sr to SAMPLE_RATE; the sinc kernel is built once per rate."""
+    return torchaudio.transforms.Resample(orig_sr, SAMPLE_RATE)
+
+def load_audio(audio_path, offset=0.0, duration=None):
+    """
+    Load an audio file as 16kHz mono float32 samples.
     
-    # Extract mel spectrogram (Fbank energies)
-    mel_spec = librosa.feature.melspectrogram(
-        y=audio,
-        sr=sr,
-        n_fft=n_fft,
-        hop_length=hop_length,
-        n_mels=n_mels,
-        fmin=0,
-        fmax=sr/2,
-        power=2.0  # Power spectrum
-    )
+    Decodes with libsndfile (no audioread/ffmpeg fallback), reading 16-bit
+    PCM as int16, and resamples only when the file is not already 16kHz.
     
-    # Convert to log scale (dB)
-    log_mel = librosa.power_to_db(mel_spec, ref=np.max)
+    Parameters:
+    - audio_path: Path to audio file
+    - offset: Start time in seconds
+    - duration: Length in seconds (None reads to the end)
+    """
+    # One open serves the header (rate, subtype) and the read
+    with sf.SoundFile(audio_path) as f:
+        sr = f.samplerate
+        frames = -1 if duration is None else int(duration * sr)
+        f.seek(int(offset * sr))
+        
+        if f.subtype == "PCM_16":
+            # Decode straight to int16 (half the bytes of float32) and scale once
+            audio = f.read(frames, dtype="int16").astype(np.float32) * (1.0 / 32768.0)
+        else:
+            audio = f.read(frames, dtype="float32")
     
-    print(f"Mel spectrogram shape: {mel_spec.shape} (mels, time_frames)")
-    print(f"Log-mel range: [{log_mel.min():.2f}, {log_mel.max():.2f}] dB")
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if sr != SAMPLE_RATE:
+        with torch.no_grad():
+            audio = _resampler(sr)(torch.from_numpy(audio)).numpy()
     
-    # Transpose to [time, features] and add batch dimension
-    features = np.transpose(log_mel).astype(np.float32)
-    features = np.expand_dims(features, axis=0)  # Shape: [1, T, 80]
+    log.debug("Audio loaded: %d samples, %d Hz, %.2f seconds", len(audio), SAMPLE_RATE, len(audio) / SAMPLE_RATE)
     
-    print(f"Final feature shape: {features.shape} (batch, time, mels)")
+    return audio
+
+def _get_binding(sess, input_name, output_name, shape):
+    """
+    IOBinding with a preallocated float32 input buffer of the given shape.
     
-    return features
+    The OrtValue wraps the numpy buffer without copying, so refilling the
+    buffer in place updates the bound input. Only the _MAX_BINDINGS most
+    recently used shapes are kept per session.
+    """
+    bindings = _BINDINGS.setdefault(sess, OrderedDict())
+    key = (input_name, shape)
+    if key in bindings:
+        bindings.move_to_end(key)
+        return bindings[key]
+    
+    buffer = np.empty(shape, dtype=np.float32)
+    io = sess.io_binding()
+    io.bind_ortvalue_input(input_name, ort.OrtValue.ortvalue_from_numpy(buffer))
+    io.bind_output(output_name, device_type="cpu")
+    bindings[key] = (io, buffer)
+    if len(bindings) > _MAX_BINDINGS:
+        bindings.popitem(last=False)  # Evict the least recently used shape
+    return bindings[key]
 
-def test_wespeaker_model(model_path, audio_path):
+def embed_batch(sess, feats_list, input_name=_INPUT_NAME, output_name=_OUTPUT_NAME):
     """
-    Test WeSpeaker ONNX model with proper feature extraction.
+    Run ONNX inference over several clips, batching clips of equal length.
+    
+    Clips are grouped by length and each group runs as one batch. Nothing is
+    padded: statistics pooling would average over the padding, making a clip's
+    embedding depend on the other clips in the call.
+    
+    Parameters:
+    - sess: onnxruntime.InferenceSession
+    - feats_list: list of np.array [T_i, 80] feature matrices
+      (or [T_i] waveforms for models with the fused frontend)
+    - input_name: Model input name (defaults to the shared session's input)
+    - output_name: Model output name (defaults to the shared session's output)
+    
+    Returns:
+    - embeddings: np.array of shape [len(feats_list), embedding_dim]
+    """
+    groups = {}
+    for i, f in enumerate(feats_list):
+        groups.setdefault(f.shape, []).append(i)
+    
+    embeddings = [None] * len(feats_list)
+    for shape, indices in groups.items():
+        # Shape: [B, T, 80] (or [B, samples]) - the model declares a dynamic batch axis
+        io, batch = _get_binding(sess, input_name, output_name, (len(indices),) + shape)
+        
+        # Refill the bound buffer in place instead of allocating a new input tensor
+        for row, i in enumerate(indices):
+            batch[row] = feats_list[i]
+        
+        io.synchronize_inputs()
+        sess.run_with_iobinding(io)
+        for i, embedding in zip(indices, io.copy_outputs_to_cpu()[0]):
+            embeddings[i] = embedding
+    
+    return np.stack(embeddings)
+
+def embed_audio_batch(sess, audio_list):
+    """
+    Embeddings for a list of 16kHz waveforms (one ONNX run per distinct length).
+    
+    Waveform-input models compute features inside the graph; for feature-input
+    models the features are extracted here first. Bytes-input models only
+    take encoded files - use embed_file() for those.
+    """
+    if _BYTES_INPUT:
+        raise ValueError(f"{MODEL_PATH} takes encoded audio bytes; use embed_file() instead")
+    if _WAVEFORM_INPUT:
+        return embed_batch(sess, audio_list)
+    return embed_batch(sess, [log_mel_features(audio) for audio in audio_list])
+
+def _embed_wav_bytes(sess, data, input_name=_INPUT_NAME):
+    """Embedding for one encoded WAV file on a bytes-input model."""
+    stream = np.frombuffer(data, dtype=np.uint8)[np.newaxis, :]
+    return sess.run(None, {input_name: stream})[0][0]
+
+def embed_file(sess, audio_path):
     """
-    print("=" * 60)
-    print("Testing WeSpeaker ONNX Model")
-    print("=" * 60)
+    Embedding for one audio file.
     
-    # Load ONNX model
-    print(f"\nLoading model: {model_path}")
-    sess = ort.InferenceSession(model_path)
+    Bytes-input models get the file contents as-is, so no decoding or
+    feature extraction happens in Python; other models load it first.
+    """
+    if _BYTES_INPUT:
+        with open(audio_path, "rb") as f:
+            return _embed_wav_bytes(sess, f.read())
+    return embed_audio_batch(sess, [load_audio(audio_path)])[0]
+
+def cosine_matrix(embeddings):
+    """
+    All-pairs cosine similarity for embeddings [N, dim] as a single GEMM.
     
-    # Print model info
+    Returns:
+    - similarity: np.array of shape [N, N]
+    """
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+    normalized = embeddings / norms
+    return normalized @ normalized.T
+
+def test_wespeaker_model(sess, audio_path):
+    """
+    Test WeSpeaker ONNX model with proper feature extraction.
+    """
+    log.info("=" * 60)
+    log.info("Testing WeSpeaker ONNX Model")
+    log.info("=" * 60)
+    
+    # Model info
     input_info = sess.get_inputs()[0]
     output_info = sess.get_outputs()[0]
-    print(f"Input: {input_info.name}, shape={input_info.shape}, type={input_info.type}")
-    print(f"Output: {output_info.name}, shape={output_info.shape}, type={output_info.type}")
+    log.info("Input: %s, shape=%s, type=%s", input_info.name, input_info.shape, input_info.type)
+    log.info("Output: %s, shape=%s, type=%s", output_info.name, output_info.shape, output_info.type)
     
-    # Extract features
-    print(f"\nExtracting features from: {audio_path}")
-    features = extract_fbank_features(audio_path)
+    # Decoding and log-mel run in the graph or in load_audio()/log_mel_features()
+    log.info("\nAudio file: %s", audio_path)
+    if _BYTES_INPUT:
+        log.info("Feature extraction: decode + features in ONNX graph (onnxruntime-extensions)")
+    else:
+        log.info("Feature extraction: %s", "features in ONNX graph" if _WAVEFORM_INPUT else "Python log-mel")
     
     # Run inference
-    print("\nRunning ONNX inference...")
+    log.info("\nRunning ONNX inference...")
     try:
-        outputs = sess.run(None, {input_info.name: features})
-        embedding = outputs[0][0]  # Shape: [256]
+        embedding = embed_file(sess, audio_path)  # Shape: [256]
         
-        print(f"✅ Inference successful!")
-        print(f"Embedding shape: {embedding.shape}")
-        print(f"Embedding L2 norm: {np.linalg.norm(embedding):.6f}")
-        print(f"Embedding mean: {embedding.mean():.6f}")
-        print(f"Embedding std: {embedding.std():.6f}")
-        print(f"Embedding range: [{embedding.min():.6f}, {embedding.max():.6f}]")
+        log.info("✅ Inference successful!")
+        log.info("Embedding shape: %s", embedding.shape)
+        log.info("Embedding L2 norm: %.6f", np.linalg.norm(embedding))
+        log.info("Embedding mean: %.6f", embedding.mean())
+        log.info("Embedding std: %.6f", embedding.std())
+        log.info("Embedding range: [%.6f, %.6f]", embedding.min(), embedding.max())
         
         # Show first 10 dimensions
-        print(f"\nFirst 10 dimensions: {embedding[:10]}")
+        log.info("\nFirst 10 dimensions: %s", embedding[:10])
         
         return embedding
         
     except Exception as e:
-        print(f"❌ Inference failed: {e}")
+        log.error("❌ Inference failed: %s", e)
         return None
 
-def compare_embeddings(model_path, audio1_path, audio2_path):
+def compare_embeddings(sess, audio1_path, audio2_path):
     """
     Compare embeddings from two audio files (cosine similarity).
     """
-    print("\n" + "=" * 60)
-    print("Comparing Two Audio Samples")
-    print("=" * 60)
+    log.info("\n" + "=" * 60)
+    log.info("Comparing Two Audio Samples")
+    log.info("=" * 60)
     
-    features1 = extract_fbank_features(audio1_path)
-    features2 = extract_fbank_features(audio2_path)
-    
-    sess = ort.InferenceSession(model_path)
-    input_name = sess.get_inputs()[0].name
-    
-    emb1 = sess.run(None, {input_name: features1})[0][0]
-    emb2 = sess.run(None, {input_name: features2})[0][0]
+    if _BYTES_INPUT:
+        # The in-graph decoder takes one file per run
+        embeddings = np.stack([embed_file(sess, audio1_path), embed_file(sess, audio2_path)])
+    else:
+        # Equal-length clips share one batched run
+        embeddings = embed_audio_batch(sess, [load_audio(audio1_path), load_audio(audio2_path)])
     
     # Cosine similarity
-    similarity = np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2))
+    similarity = cosine_matrix(embeddings)[0, 1]
     
-    print(f"\nCosine similarity: {similarity:.4f}")
-    print(f"  > 0.7: Same speaker (high confidence)")
-    print(f"  0.5-0.7: Likely same speaker")
-    print(f"  0.3-0.5: Uncertain")
-    print(f"  < 0.3: Different speakers")
+    log.info("\nCosine similarity: %.4f", similarity)
+    log.info("  > 0.7: Same speaker (high confidence)")
+    log.info("  0.5-0.7: Likely same speaker")
+    log.info("  0.3-0.5: Uncertain")
+    log.info("  < 0.3: Different speakers")
     
     return similarity
 
 if __name__ == "__main__":
-    model_path = "models/speaker_embedding.onnx"
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    
+    log.info("Loaded model: %s", MODEL_PATH)
+    if cache_supported():
+        log.info("Optimized graph cached at: %s", optimized_cache_path(MODEL_PATH))
     
     # Test with Sean Carroll podcast
     audio_path = "test_data/Sean_Carroll_podcast.wav"
     
-    print("Testing with Sean Carroll podcast...")
-    embedding = test_wespeaker_model(model_path, audio_path)
+    log.info("Testing with Sean Carroll podcast...")
+    embedding = test_wespeaker_model(sess, audio_path)
     
     if embedding is not None:
-        print("\n" + "=" * 60)
-        print("SUCCESS! Feature extraction approach works!")
-        print("=" * 60)
-        print("\nNext steps:")
-        print("1. Implement Fbank extraction in C++")
-        print("2. Integrate with OnnxSpeakerEmbedder::preprocess_audio()")
-        print("3. Test with full diarization pipeline")
+        log.info("\n" + "=" * 60)
+        log.info("SUCCESS! Feature extraction approach works!")
+        log.info("=" * 60)
+        log.info("\nNext steps:")
+        log.info("1. Implement Fbank extraction in C++")
+        log.info("2. Integrate with OnnxSpeakerEmbedder::preprocess_audio()")
+        log.info("3. Test with full diarization pipeline")